@@ -1,14 +1,57 @@
 from os import getenv
 from sys import exit
-from typing import Optional
+from typing import Iterator, Mapping, Optional
+from base64 import b64decode
+from hashlib import sha256
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 import time
 import logging
-import json
 
-from requests import post, put
-from kubernetes import client, config
+import orjson
+from requests import Response, Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from kubernetes import client, config, watch
 from kubernetes.client.rest import ApiException
 
+# shared session so harness api calls reuse the same connection
+_session = Session()
+_session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=2,
+        pool_maxsize=10,
+        # return the last 5xx response so callers can report its body
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[502, 503, 504],
+            raise_on_status=False,
+        ),
+    ),
+)
+
+# kubernetes api client, shared by all k8s helpers (see get_core_v1)
+_K8S_CLIENT: Optional[client.CoreV1Api] = None
+
+# base url of the harness secrets api, set once by configure_harness_session()
+# or lazily from the environment on the first harness request
+_HARNESS_BASE: Optional[str] = None
+
+
+def _write_env_file(path: str, outputs: dict[str, str]):
+    """
+    write key value outputs to an env file in a single write
+
+    args:
+        path (str): file to write
+        outputs (dict[str, str]): string to string mappings
+    """
+
+    with open(path, "w") as output_file:
+        output_file.write("".join(f"{k}={v}\n" for k, v in outputs.items()))
+
 
 def write_outputs(outputs: dict[str, str]):
     """
@@ -18,12 +61,7 @@ def write_outputs(outputs: dict[str, str]):
         outputs (dict[str, str]): string to string mappings
     """
 
-    output_file = open(getenv("DRONE_OUTPUT", "DRONE_OUTPUT.env"), "w")
-
-    for k, v in outputs.items():
-        output_file.write(f"{k}={v}\n")
-
-    output_file.close()
+    _write_env_file(getenv("DRONE_OUTPUT", "DRONE_OUTPUT.env"), outputs)
 
 
 def write_secret_outputs(outputs: dict[str, str]):
@@ -34,16 +72,30 @@ def write_secret_outputs(outputs: dict[str, str]):
         outputs (dict[str, str]): string to string mappings
     """
 
-    output_file = open(
-        getenv("HARNESS_OUTPUT_SECRET_FILE", "HARNESS_OUTPUT_SECRET.env"), "w"
+    _write_env_file(
+        getenv("HARNESS_OUTPUT_SECRET_FILE", "HARNESS_OUTPUT_SECRET.env"), outputs
     )
 
-    for k, v in outputs.items():
-        output_file.write(f"{k}={v}\n")
 
-    output_file.close()
+def _label_value(value: str) -> str:
+    """
+    shorten a value to fit the 63 character limit on kubernetes label values
+    values that are too long are truncated and suffixed with a hash of the full value
+
+    args:
+        value (str): value to use as a label
+
+    returns:
+        str: the value, or a shortened unique form of it
+    """
+
+    if len(value) <= 63:
+        return value
 
+    return f"{value[:52]}-{sha256(value.encode()).hexdigest()[:10]}"
 
+
+@lru_cache(maxsize=None)
 def check_env(variable: str, default: str = None):
     """
     resolves an environment variable, returning a default if not found
@@ -86,8 +138,40 @@ def load_k8s_config(kubeconfig_path: Optional[str] = None):
             config.load_kube_config()
 
 
+def get_core_v1(kubeconfig_path: Optional[str] = None) -> client.CoreV1Api:
+    """
+    Return the shared kubernetes core v1 api client, loading configuration on first use
+
+    args:
+        kubeconfig_path (str, optional): Path to kubeconfig file
+
+    returns:
+        client.CoreV1Api: the shared api client
+    """
+    global _K8S_CLIENT
+
+    if _K8S_CLIENT is None:
+        load_k8s_config(kubeconfig_path)
+        configuration = client.Configuration.get_default_copy()
+        # size the pool for the concurrent calls made by main()
+        configuration.connection_pool_maxsize = 10
+        # let the last 5xx surface as an ApiException rather than a MaxRetryError
+        configuration.retries = Retry(
+            total=3,
+            backoff_factor=0.2,
+            status_forcelist=[502, 503, 504],
+            raise_on_status=False,
+        )
+        _K8S_CLIENT = client.CoreV1Api(api_client=client.ApiClient(configuration))
+
+    return _K8S_CLIENT
+
+
 def get_k8s_secret(
-    namespace: str, name: str, kubeconfig_path: Optional[str] = None
+    namespace: str,
+    name: str,
+    kubeconfig_path: Optional[str] = None,
+    v1: Optional[client.CoreV1Api] = None,
 ) -> dict:
     """
     Resolve the value of a kubernetes secret
@@ -96,26 +180,19 @@ def get_k8s_secret(
         namespace (str): Kubernetes namespace where the secret exists
         name (str): Name of the secret to retrieve
         kubeconfig_path (str, optional): Path to kubeconfig file
+        v1 (client.CoreV1Api, optional): api client to use, defaults to the shared client
 
     returns:
         dict: Dictionary containing the secret data (decoded from base64)
     """
-    import base64
-
     try:
-        load_k8s_config(kubeconfig_path)
-        v1 = client.CoreV1Api()
+        v1 = v1 or get_core_v1(kubeconfig_path)
 
         # Retrieve the secret
         secret = v1.read_namespaced_secret(name=name, namespace=namespace)
 
         # Decode secret data from base64
-        secret_data = {}
-        if secret.data:
-            for key, value in secret.data.items():
-                secret_data[key] = base64.b64decode(value).decode("utf-8")
-
-        return secret_data
+        return {k: b64decode(v).decode("utf-8") for k, v in (secret.data or {}).items()}
 
     except ApiException as e:
         print(f"Error retrieving secret '{name}' from namespace '{namespace}': {e}")
@@ -126,8 +203,9 @@ def create_service_account_token(
     namespace: str,
     service_account: str,
     token_name: str,
-    labels: dict[str, str] = {},
+    labels: Optional[Mapping[str, str]] = None,
     kubeconfig_path: Optional[str] = None,
+    v1: Optional[client.CoreV1Api] = None,
 ) -> str:
     """
     Create a kubernetes service account token
@@ -136,16 +214,15 @@ def create_service_account_token(
         namespace (str): Kubernetes namespace where the service account exists
         service_account (str): Name of the service account
         token_name (str): Name for the token secret
+        labels (Mapping[str, str], optional): labels to set on the token secret
         kubeconfig_path (str, optional): Path to kubeconfig file
+        v1 (client.CoreV1Api, optional): api client to use, defaults to the shared client
 
     returns:
         str: The generated token
     """
-    import base64
-
     try:
-        load_k8s_config(kubeconfig_path)
-        v1 = client.CoreV1Api()
+        v1 = v1 or get_core_v1(kubeconfig_path)
 
         # Create a secret of type kubernetes.io/service-account-token
         secret = client.V1Secret(
@@ -154,7 +231,7 @@ def create_service_account_token(
             metadata=client.V1ObjectMeta(
                 name=token_name,
                 annotations={"kubernetes.io/service-account.name": service_account},
-                labels=labels,
+                labels=dict(labels) if labels else {},
             ),
             type="kubernetes.io/service-account-token",
         )
@@ -165,86 +242,188 @@ def create_service_account_token(
             print(f"Service account token '{token_name}' created successfully")
         except ApiException as e:
             if e.status == 409:
-                # Secret already exists, retrieve it
-                print(
-                    f"Service account token '{token_name}' already exists, retrieving..."
-                )
-                v1.read_namespaced_secret(name=token_name, namespace=namespace)
+                # Secret already exists, the token is read below once populated
+                print(f"Service account token '{token_name}' already exists, reusing")
             else:
                 raise
 
         # Wait for the token to be populated (it may take a moment)
-        max_retries = 10
-        for i in range(max_retries):
-            secret_obj = v1.read_namespaced_secret(name=token_name, namespace=namespace)
-            if secret_obj.data and "token" in secret_obj.data:
-                token = base64.b64decode(secret_obj.data["token"]).decode("utf-8")
-                return token
-            time.sleep(1)
+        # watch the secret so we are notified as soon as the controller fills it in
+        w = watch.Watch()
+        try:
+            for event in w.stream(
+                v1.list_namespaced_secret,
+                namespace=namespace,
+                field_selector=f"metadata.name={token_name}",
+                timeout_seconds=15,
+            ):
+                secret_obj = event["object"]
+                if secret_obj.data and "token" in secret_obj.data:
+                    w.stop()
+                    return b64decode(secret_obj.data["token"]).decode("utf-8")
+        except Exception as e:
+            # fall back to polling if the watch connection fails
+            print(f"Watch on service account token '{token_name}' failed: {e}")
+            # back off exponentially from 25ms up to 1s between reads
+            max_wait = 10
+            deadline = time.monotonic() + max_wait
+            delay = 0.025
+            while True:
+                secret_obj = v1.read_namespaced_secret(
+                    name=token_name, namespace=namespace
+                )
+                if secret_obj.data and "token" in secret_obj.data:
+                    token = b64decode(secret_obj.data["token"]).decode("utf-8")
+                    return token
+                if time.monotonic() >= deadline:
+                    break
+                time.sleep(delay)
+                delay = min(delay * 2, 1.0)
+
+            raise Exception(f"Token not populated after {max_wait} seconds")
 
-        raise Exception(f"Token not populated after {max_retries} seconds")
+        raise Exception("Token not populated after 15 seconds")
 
     except ApiException as e:
         print(f"Error creating service account token '{token_name}': {e}")
         raise
 
 
-def list_k8s_secrets(
-    namespace: str, search_string: str = "", kubeconfig_path: Optional[str] = None
-) -> list[dict]:
+def iter_k8s_secrets(
+    namespace: str,
+    label_selector: str = "",
+    field_selector: str = "",
+    kubeconfig_path: Optional[str] = None,
+    v1: Optional[client.CoreV1Api] = None,
+    page_size: int = 500,
+) -> Iterator[dict]:
     """
-    Retrieve a list of Kubernetes secrets in a namespace that match a search string.
+    Lazily iterate Kubernetes secrets in a namespace that match a label selector, one page at a time.
 
     args:
         namespace (str): Kubernetes namespace to search in
-        search_string (str): String to search for in secret names (case-insensitive). Empty string returns all secrets.
+        label_selector (str): Label selector evaluated by the api server, e.g. `key=value,key2=value2`. Empty string returns all secrets.
+        field_selector (str): Field selector evaluated by the api server, e.g. `type=kubernetes.io/service-account-token`
         kubeconfig_path (str, optional): Path to kubeconfig file
+        v1 (client.CoreV1Api, optional): api client to use, defaults to the shared client
+        page_size (int): Maximum number of secrets requested per page
 
-    returns:
-        list[dict]: List of dictionaries containing secret metadata (name, type, creation_timestamp, data_keys)
+    yields:
+        dict: Secret metadata (name, type, creation_timestamp, data_keys, service_account)
     """
     try:
-        load_k8s_config(kubeconfig_path)
-        v1 = client.CoreV1Api()
-
-        # List all secrets in the namespace
-        secrets = v1.list_namespaced_secret(namespace=namespace)
-
-        # Filter secrets by search string
-        matching_secrets = []
-        search_lower = search_string.lower()
-
-        for secret in secrets.items:
-            secret_name = secret.metadata.name
-
-            # If search string is empty or matches the secret name
-            if not search_string or search_lower in secret_name.lower():
-                secret_info = {
-                    "name": secret_name,
-                    "type": secret.type,
-                    "creation_timestamp": secret.metadata.creation_timestamp.isoformat()
-                    if secret.metadata.creation_timestamp
-                    else None,
-                    "data_keys": list(secret.data.keys()) if secret.data else [],
+        v1 = v1 or get_core_v1(kubeconfig_path)
+
+        continue_token = None
+        while True:
+            # List secrets in the namespace, filtered server side by label
+            # read the raw json rather than deserializing every secret into a model
+            kwargs = {"_continue": continue_token} if continue_token else {}
+            response = v1.list_namespaced_secret(
+                namespace=namespace,
+                label_selector=label_selector,
+                field_selector=field_selector,
+                limit=page_size,
+                _preload_content=False,
+                _request_timeout=15,
+                **kwargs,
+            )
+            secrets = orjson.loads(response.data)
+
+            for secret in secrets["items"]:
+                yield {
+                    "name": secret["metadata"]["name"],
+                    "type": secret.get("type"),
+                    "creation_timestamp": secret["metadata"].get("creationTimestamp"),
+                    "data_keys": list((secret.get("data") or {}).keys()),
+                    "service_account": (
+                        secret["metadata"].get("annotations") or {}
+                    ).get("kubernetes.io/service-account.name"),
                 }
-                matching_secrets.append(secret_info)
 
-        return matching_secrets
+            continue_token = secrets["metadata"].get("continue")
+            if not continue_token:
+                break
 
     except ApiException as e:
         print(f"Error listing secrets in namespace '{namespace}': {e}")
         raise
 
 
+def list_k8s_secrets(
+    namespace: str,
+    label_selector: str = "",
+    field_selector: str = "",
+    kubeconfig_path: Optional[str] = None,
+    v1: Optional[client.CoreV1Api] = None,
+) -> list[dict]:
+    """
+    Retrieve a list of Kubernetes secrets in a namespace that match a label selector.
+
+    args:
+        namespace (str): Kubernetes namespace to search in
+        label_selector (str): Label selector evaluated by the api server, e.g. `key=value,key2=value2`. Empty string returns all secrets.
+        field_selector (str): Field selector evaluated by the api server, e.g. `type=kubernetes.io/service-account-token`
+        kubeconfig_path (str, optional): Path to kubeconfig file
+        v1 (client.CoreV1Api, optional): api client to use, defaults to the shared client
+
+    returns:
+        list[dict]: List of dictionaries containing secret metadata (name, type, creation_timestamp, data_keys, service_account)
+    """
+
+    return list(
+        iter_k8s_secrets(namespace, label_selector, field_selector, kubeconfig_path, v1)
+    )
+
+
+def list_legacy_service_account_tokens(
+    namespace: str,
+    service_account: str,
+    scope_selector: str,
+    kubeconfig_path: Optional[str] = None,
+    v1: Optional[client.CoreV1Api] = None,
+) -> list[dict]:
+    """
+    Retrieve tokens minted by plugin versions that did not set the `service_account` label.
+
+    These are matched on the harness scope labels they do carry, then filtered on the
+    `kubernetes.io/service-account.name` annotation set by the token controller.
+
+    args:
+        namespace (str): Kubernetes namespace to search in
+        service_account (str): Name of the service account the tokens belong to
+        scope_selector (str): Label selector for the harness account, org, and project
+        kubeconfig_path (str, optional): Path to kubeconfig file
+        v1 (client.CoreV1Api, optional): api client to use, defaults to the shared client
+
+    returns:
+        list[dict]: List of dictionaries containing secret metadata, as returned by list_k8s_secrets
+    """
+
+    return [
+        secret
+        for secret in iter_k8s_secrets(
+            namespace,
+            f"{scope_selector},!service_account",
+            "type=kubernetes.io/service-account-token",
+            kubeconfig_path,
+            v1,
+        )
+        if secret["service_account"] == service_account
+    ]
+
+
 def delete_k8s_secret(
-    namespace: str, secret_name: str, kubeconfig_path: Optional[str] = None
+    namespace: str,
+    secret_name: str,
+    kubeconfig_path: Optional[str] = None,
+    v1: Optional[client.CoreV1Api] = None,
 ):
     """
     Delete a kubernetes secret
     """
     try:
-        load_k8s_config(kubeconfig_path)
-        v1 = client.CoreV1Api()
+        v1 = v1 or get_core_v1(kubeconfig_path)
 
         # Delete the secret
         v1.delete_namespaced_secret(name=secret_name, namespace=namespace)
@@ -255,37 +434,157 @@ def delete_k8s_secret(
         raise
 
 
-def create_harness_secret(
+def delete_k8s_secrets(
+    namespace: str,
+    label_selector: str,
+    field_selector: str = "",
+    kubeconfig_path: Optional[str] = None,
+    v1: Optional[client.CoreV1Api] = None,
+):
+    """
+    Delete all kubernetes service account tokens matching a selector in a single request
+
+    args:
+        namespace (str): Kubernetes namespace to delete secrets from
+        label_selector (str): Label selector for the secrets to delete, must not be empty
+        field_selector (str): Additional field selector for the secrets to delete, e.g. `metadata.name!=<name>`
+        kubeconfig_path (str, optional): Path to kubeconfig file
+        v1 (client.CoreV1Api, optional): api client to use, defaults to the shared client
+    """
+    # an empty selector would delete every secret in the namespace
+    if not label_selector:
+        raise ValueError("label_selector is required to delete secrets")
+
+    # only ever delete service account tokens, whatever other secrets share the labels
+    field_selector = ",".join(
+        selector
+        for selector in ("type=kubernetes.io/service-account-token", field_selector)
+        if selector
+    )
+
+    try:
+        v1 = v1 or get_core_v1(kubeconfig_path)
+
+        # Delete the matching secrets server side
+        v1.delete_collection_namespaced_secret(
+            namespace=namespace,
+            label_selector=label_selector,
+            field_selector=field_selector,
+        )
+
+        print(f"Secrets matching '{label_selector}' deleted successfully")
+    except ApiException as e:
+        print(f"Error deleting secrets matching '{label_selector}': {e}")
+        raise
+
+
+def configure_harness_session(harness_url: str, api_key: str):
+    """
+    Resolve the harness secrets api url and set the api key on the shared session
+
+    args:
+        harness_url (str): harness hostname, e.g. `app.harness.io`
+        api_key (str): harness platform api key
+    """
+    global _HARNESS_BASE
+
+    _HARNESS_BASE = f"https://{harness_url}/gateway/ng/api/v2/secrets"
+    _session.headers.update({"x-api-key": api_key})
+
+
+def _harness_request(
+    method: str,
+    path: str,
+    harness_account: str,
+    params: dict,
+    payload: Optional[dict] = None,
+) -> Response:
+    """
+    Send a request to the harness secrets api using the shared session
+
+    args:
+        method (str): http method to use
+        path (str): path relative to the secrets api, e.g. `/<identifier>`
+        harness_account (str): harness account id
+        params (dict): query parameters
+        payload (dict, optional): json body
+
+    returns:
+        Response: the harness api response
+    """
+
+    # support callers that use the harness helpers without going through main()
+    if _HARNESS_BASE is None:
+        configure_harness_session(
+            check_env("PLUGIN_HARNESS_URL", "app.harness.io"),
+            check_env("PLUGIN_HARNESS_PLATFORM_API_KEY"),
+        )
+
+    headers = {"Harness-Account": harness_account}
+    data = None
+    if payload is not None:
+        headers["Content-Type"] = "application/json"
+        data = orjson.dumps(payload)
+
+    return _session.request(
+        method,
+        f"{_HARNESS_BASE}{path}",
+        headers=headers,
+        params=params,
+        data=data,
+        timeout=(5, 30),
+    )
+
+
+def _build_harness_params(
+    harness_account: str, harness_org: str, harness_project: str
+) -> dict:
+    """
+    Build the query parameters scoping a harness api call to an account, org, and project
+
+    returns:
+        dict: query parameters
+    """
+
+    params = {
+        "routingId": harness_account,
+        "accountIdentifier": harness_account,
+    }
+    if harness_org:
+        params["orgIdentifier"] = harness_org
+    if harness_project:
+        params["projectIdentifier"] = harness_project
+
+    return params
+
+
+def _build_harness(
     harness_account: str,
     harness_org: str,
     harness_project: str,
     secret_identifier: str,
     token: str,
-    tags: dict[str, str] = {},
+    tags: Optional[Mapping[str, str]] = None,
     description: str = "",
     secret_manager: str = "",
-) -> bool:
+) -> tuple[dict, dict]:
     """
-    Create a harness secret
+    Build the query parameters and payload used to create or update a harness secret
 
-    If the secret already exists, update its value
+    returns:
+        tuple[dict, dict]: query parameters and json payload
     """
 
     params = {
         "private_secret": "false",
-        "routingId": harness_account,
-        "accountIdentifier": harness_account,
+        **_build_harness_params(harness_account, harness_org, harness_project),
     }
-    if harness_org:
-        params["orgIdentifier"] = harness_org
-    if harness_project:
-        params["projectIdentifier"] = harness_project
 
     payload = {
         "secret": {
             "name": secret_identifier,
             "identifier": secret_identifier,
-            "tags": tags,
+            "tags": dict(tags) if tags else {},
             "description": description,
             "type": "SecretText",
             "spec": {
@@ -301,15 +600,28 @@ def create_harness_secret(
     if harness_project:
         payload["secret"]["projectIdentifier"] = harness_project
 
-    response = post(
-        f"https://{check_env('PLUGIN_HARNESS_URL', 'app.harness.io')}/gateway/ng/api/v2/secrets",
-        headers={
-            "Harness-Account": harness_account,
-            "x-api-key": check_env("PLUGIN_HARNESS_PLATFORM_API_KEY"),
-        },
-        params=params,
-        json=payload,
-    )
+    return params, payload
+
+
+def _harness_secret_exists(
+    harness_account: str,
+    harness_org: str,
+    harness_project: str,
+    secret_identifier: str,
+) -> bool:
+    """
+    Check whether a harness secret exists
+
+    returns:
+        bool: False if harness returns 404 for the secret, True otherwise
+    """
+
+    params = _build_harness_params(harness_account, harness_org, harness_project)
+
+    response = _harness_request("GET", f"/{secret_identifier}", harness_account, params)
+
+    if response.status_code == 404:
+        return False
 
     try:
         response.raise_for_status()
@@ -320,80 +632,74 @@ def create_harness_secret(
     return True
 
 
-def update_harness_secret(
+def create_harness_secret(
     harness_account: str,
     harness_org: str,
     harness_project: str,
     secret_identifier: str,
     token: str,
-    tags: dict[str, str] = {},
+    tags: Optional[Mapping[str, str]] = None,
     description: str = "",
     secret_manager: str = "",
 ) -> bool:
     """
-    Update a harness secret
-
-    Create if not exists
+    Create a new harness secret
     """
 
-    params = {
-        "private_secret": "false",
-        "routingId": harness_account,
-        "accountIdentifier": harness_account,
-    }
-    if harness_org:
-        params["orgIdentifier"] = harness_org
-    if harness_project:
-        params["projectIdentifier"] = harness_project
+    params, payload = _build_harness(
+        harness_account,
+        harness_org,
+        harness_project,
+        secret_identifier,
+        token,
+        tags,
+        description,
+        secret_manager,
+    )
 
-    payload = {
-        "secret": {
-            "name": secret_identifier,
-            "identifier": secret_identifier,
-            "tags": tags,
-            "description": description,
-            "type": "SecretText",
-            "spec": {
-                "secretManagerIdentifier": secret_manager,
-                "valueType": "Inline",
-                "value": token,
-            },
-        }
-    }
+    response = _harness_request("POST", "", harness_account, params, payload)
 
-    if harness_org:
-        payload["secret"]["orgIdentifier"] = harness_org
-    if harness_project:
-        payload["secret"]["projectIdentifier"] = harness_project
+    try:
+        response.raise_for_status()
+    except Exception as e:
+        print(response.text)
+        raise e
 
-    response = put(
-        f"https://{check_env('PLUGIN_HARNESS_URL', 'app.harness.io')}/gateway/ng/api/v2/secrets/{secret_identifier}",
-        headers={
-            "Harness-Account": harness_account,
-            "x-api-key": check_env("PLUGIN_HARNESS_PLATFORM_API_KEY"),
-        },
-        params=params,
-        json=payload,
+    return True
+
+
+def update_harness_secret(
+    harness_account: str,
+    harness_org: str,
+    harness_project: str,
+    secret_identifier: str,
+    token: str,
+    tags: Optional[Mapping[str, str]] = None,
+    description: str = "",
+    secret_manager: str = "",
+) -> bool:
+    """
+    Update an existing harness secret
+    """
+
+    params, payload = _build_harness(
+        harness_account,
+        harness_org,
+        harness_project,
+        secret_identifier,
+        token,
+        tags,
+        description,
+        secret_manager,
+    )
+
+    response = _harness_request(
+        "PUT", f"/{secret_identifier}", harness_account, params, payload
     )
 
     try:
         response.raise_for_status()
     except Exception as e:
-        try:
-            data = response.json()
-            if "No such secret found" in data.get("message"):
-                return create_harness_secret(
-                    harness_account,
-                    harness_org,
-                    harness_project,
-                    secret_identifier,
-                    token,
-                    tags,
-                    description,
-                    secret_manager,
-                )
-        except Exception as f:
-            raise f
         print(response.text)
         raise e
 
@@ -403,6 +709,11 @@ def update_harness_secret(
 def main():
     current_unix_timestamp = int(time.time())
 
+    configure_harness_session(
+        check_env("PLUGIN_HARNESS_URL", "app.harness.io"),
+        check_env("PLUGIN_HARNESS_PLATFORM_API_KEY"),
+    )
+
     namespace = check_env("PLUGIN_NAMESPACE", "harness-delegate-ng")
     service_account_name = check_env(
         "PLUGIN_SERVICE_ACCOUNT_NAME", "harness-delegate-ng"
@@ -413,29 +724,102 @@ def main():
     harness_project = check_env("PLUGIN_HARNESS_PROJECT", None)
 
     secret_identifier = check_env("PLUGIN_SECRET_IDENTIFIER", service_account_name)
-    secret_tags = json.loads(check_env("PLUGIN_SECRET_TAGS", "{}"))
+    secret_tags = orjson.loads(check_env("PLUGIN_SECRET_TAGS", "{}"))
+
+    # decide up front whether the harness secret needs to be created or updated
+    try:
+        secret_exists = _harness_secret_exists(
+            harness_account, harness_org, harness_project, secret_identifier
+        )
+    except Exception as e:
+        logging.error(f"Failed to look up harness secret: {e}")
+        return
 
     new_token_name = f"{service_account_name}-{current_unix_timestamp}"
     labels = {
-        "harness_account": harness_account,
+        k: _label_value(v)
+        for k, v in (
+            ("harness_account", harness_account),
+            ("service_account", service_account_name),
+            ("harness_org", harness_org),
+            ("harness_project", harness_project),
+        )
+        if v
     }
-    if harness_org:
-        labels["harness_org"] = harness_org
-    if harness_project:
-        labels["harness_project"] = harness_project
-
-    secrets = list_k8s_secrets(namespace, service_account_name)
-    logging.info(
-        f"Found {len(secrets)} existing secrets for service account {service_account_name}"
+    # require unset scopes to be absent, so an account level run does not select
+    # tokens minted for org or project level harness secrets
+    scope_selector = ",".join(
+        f"{k}={labels[k]}" if k in labels else f"!{k}"
+        for k in ("harness_account", "harness_org", "harness_project")
     )
+    label_selector = f"{scope_selector},service_account={labels['service_account']}"
+
+    v1 = get_core_v1()
+
+    delete_old_tokens = check_env("PLUGIN_DELETE_K8S_SECRETS", "")
+
+    # existing tokens are only needed for cleanup, list them while the new one is created
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        list_future = legacy_future = None
+        if delete_old_tokens:
+            list_future = executor.submit(
+                list_k8s_secrets,
+                namespace,
+                label_selector,
+                "type=kubernetes.io/service-account-token",
+                v1=v1,
+            )
+            legacy_future = executor.submit(
+                list_legacy_service_account_tokens,
+                namespace,
+                service_account_name,
+                scope_selector,
+                v1=v1,
+            )
+        token_future = executor.submit(
+            create_service_account_token,
+            namespace,
+            service_account_name,
+            new_token_name,
+            labels,
+            v1=v1,
+        )
 
-    token = create_service_account_token(
-        namespace, service_account_name, new_token_name, labels
-    )
-    logging.info(f"Created service account token: {new_token_name}")
+        # a failed listing must not strand the new token, store it and skip cleanup
+        secrets = []
+        if list_future:
+            try:
+                # the listing may already include the new token if it was created first
+                secrets = [
+                    s for s in list_future.result() if s["name"] != new_token_name
+                ]
+                logging.info(
+                    f"Found {len(secrets)} existing secrets for service account {service_account_name}"
+                )
+            except Exception as e:
+                logging.error(f"Failed to list existing secrets, skipping cleanup: {e}")
+
+        # tokens from before the service_account label, deleted one by one by name
+        legacy_secrets = []
+        if legacy_future:
+            try:
+                legacy_secrets = legacy_future.result()
+                logging.info(
+                    f"Found {len(legacy_secrets)} unlabeled legacy tokens for service account {service_account_name}"
+                )
+            except Exception as e:
+                logging.error(
+                    f"Failed to list legacy tokens, skipping their cleanup: {e}"
+                )
 
+        token = token_future.result()
+        logging.info(f"Created service account token: {new_token_name}")
+
+    store_harness_secret = (
+        update_harness_secret if secret_exists else create_harness_secret
+    )
     try:
-        update_harness_secret(
+        store_harness_secret(
             harness_account,
             harness_org,
             harness_project,
@@ -445,15 +829,25 @@ def main():
             check_env("PLUGIN_SECRET_DESCRIPTION", "created by automation"),
             check_env("PLUGIN_SECRET_MANAGER", "harnessSecretManager"),
         )
-        logging.info(f"Updated harness secret: {secret_identifier}")
+        logging.info(
+            f"{'Updated' if secret_exists else 'Created'} harness secret: {secret_identifier}"
+        )
     except Exception as e:
-        logging.error(f"Failed to update harness secret: {e}")
+        logging.error(f"Failed to store harness secret: {e}")
         return
 
-    if check_env("PLUGIN_DELETE_K8S_SECRETS", ""):
-        for secret in secrets:
-            delete_k8s_secret(namespace, secret["name"])
-            logging.info(f"Deleted k8s secret: {secret['name']}")
+    # only send the collection delete when there are old tokens to remove
+    if secrets:
+        # never delete the token we just stored in harness
+        field_selector = f"metadata.name!={new_token_name}"
+        delete_k8s_secrets(namespace, label_selector, field_selector, v1=v1)
+        logging.info(
+            f"Deleted k8s secrets matching labels '{label_selector}' and fields '{field_selector}'"
+        )
+
+    for secret in legacy_secrets:
+        delete_k8s_secret(namespace, secret["name"], v1=v1)
+        logging.info(f"Deleted legacy k8s secret: {secret['name']}")
 
     write_outputs(
         {